@@ -1,62 +1,150 @@
 import pandas as pd
 import support.supporting_funcs as funcs
 import glob
+import os
+import hashlib
+import pyarrow as pa
+from concurrent.futures import ProcessPoolExecutor
+
+def _parquet_safe(data):
+    """data with repeated column names suffixed .1, .2, ... since parquet needs unique names"""
+    if data.columns.is_unique:
+        return data
+    return data.set_axis(funcs.unique_columns(data.columns), axis=1)
+
+def _read_cached(path, columns=None, filters=None, **kw):
+    """read a csv, keeping a parquet copy next to it for faster repeat reads
+    columns and filters are pushed down into the parquet scan"""
+    pq_path = os.path.splitext(path)[0] + ".parquet"
+    if not (os.path.exists(pq_path) and (not os.path.exists(path) or
+                                         os.path.getmtime(pq_path) >= os.path.getmtime(path))):
+        # the arrow engine keeps repeated headers as they are, parquet needs them unique
+        data = _parquet_safe(pd.read_csv(path, engine='pyarrow', dtype_backend='pyarrow', **kw))
+        data.to_parquet(pq_path, compression='zstd')
+        if columns is None and filters is None:
+            return data
+    return pd.read_parquet(pq_path, columns=columns, filters=filters, dtype_backend='pyarrow')
+
+def _write_cached(data, path, csv=False):
+    """write data as parquet, and optionally csv for legacy readers, so _read_cached can pick it up"""
+    # csv goes first so the parquet copy is never older than its source
+    if csv:
+        data.to_csv(path, index=False)
+    _parquet_safe(data).to_parquet(os.path.splitext(path)[0] + ".parquet", engine='pyarrow',
+                                   compression='zstd', row_group_size=100_000)
+
+_CACHE_DIR = ".cache"
+_IPI_SOURCES = ['Idaho_Municipal_Database_03052019.xlsx','bls_cpi_stats.xlsx','col_only.csv',
+                'emp_data.csv','gps_data.csv']
+
+def _cache_path(name, sources, *args):
+    """cache file for a result keyed on the mtimes of its sources and any call args"""
+    stamps = [(p, os.path.getmtime(p) if os.path.exists(p) else None) for p in sources]
+    key = hashlib.md5(str(stamps + list(args)).encode()).hexdigest()
+    return os.path.join(_CACHE_DIR, name + "_" + key + ".parquet")
+
+def _save_cache(data, path):
+    os.makedirs(_CACHE_DIR, exist_ok=True)
+    _parquet_safe(data).to_parquet(path, compression='zstd')
 
 def cols():
     """Return column name descriptions"""
-    ipi_cols = pd.read_csv("col_only.csv",low_memory=False)
+    ipi_cols = _read_cached("col_only.csv")
     return ipi_cols
 
+def _read_one(f):
+    """read a single yearly employment file and keep only the Idaho rows as an arrow table
+    (module level so it can be pickled)"""
+    d = pd.read_excel(f,header=[2,3,4])
+    d.columns = d.columns.map(' '.join).str.strip('|')
+    return pa.Table.from_pandas(d[d['State FIPS Code'] == 16], preserve_index=False)
+
 def empl(out=False):
     """compile employment files and produuce csv"""
     empl_files = glob.glob("employment/l*xlsx")
-    emp = pd.concat([pd.read_excel(f,header=[2,3,4]) for f in empl_files])
-    emp.columns = emp.columns.map(' '.join).str.strip('|')
-    emp = emp[emp['State FIPS Code'] == 16]
+    # each workbook parses independently, so spread them over the cores
+    with ProcessPoolExecutor() as ex:
+        tables = list(ex.map(_read_one, empl_files))
+    # arrow concat only stitches chunks together, the single to_pandas is the one copy
+    emp = pa.concat_tables(tables, promote_options='permissive').to_pandas(self_destruct=True, split_blocks=True)
     if out:
-        all_data.to_csv("emp_data.csv",index=False)
+        emp.to_csv("emp_data.csv",index=False)
     return emp
 
 def emp():
     """return already created employee data file"""
-    data = pd.read_csv("emp_data.csv")
+    data = _read_cached("emp_data.csv")
     return data
 
 def gps():
     """return already created gps data file"""
-    gps_data = pd.read_csv("gps_data.csv")
+    gps_data = _read_cached("gps_data.csv")
     return(gps_data)
 
-def ipi_abb():
+def ipi_abb(columns=None):
     # This function limits the years and cities to the best data we have
-    print("note this requires ipi_final.csv to be created (call all_data(out=True)")
-    ipi_data = pd.read_csv("ipi_final.csv",low_memory=False)
-    ipi_data = ipi_data.loc[(ipi_data['Year4'] == 1997) | (ipi_data['Year4'] == 2002)|(ipi_data['Year4'] == 2012) | (ipi_data['Year4'] == 2007)]
-    cities = pd.read_csv("best_cities.csv")
-    ipi_data = ipi_data.merge(cities,how = 'right', on='Name')
-    return(ipi_data)
-
-def all_data(out=False,norm=True):
+    # pass columns to only load the fields you need from ipi_final
+    print("note this requires ipi_final.parquet to be created (call all_data(out=True)")
+    if columns is not None:
+        columns = ['Name','Year4'] + [c for c in columns if c not in ('Name','Year4')]
+    cache = _cache_path("ipi_abb", ["ipi_final.csv","ipi_final.parquet","best_cities.csv"], columns)
+    if os.path.exists(cache):
+        # the cached frame was written from arrow backed columns, read it back the same way
+        return pd.read_parquet(cache, dtype_backend='pyarrow')
+    cities = _read_cached("best_cities.csv").set_index('Name')
+    # both the year and city predicates are applied while scanning the parquet file
+    ipi_data = _read_cached("ipi_final.csv",columns=columns,
+                            filters=[('Year4','in',[1997, 2002, 2007, 2012]),
+                                     ('Name','in',cities.index.tolist())])
+    ipi_data = ipi_data.join(cities,on='Name',how='inner')
+    # rows in best_cities order with a fresh index, as the old right merge gave them
+    order = cities.index.get_indexer(ipi_data['Name']).argsort(kind='stable')
+    ipi_data = ipi_data.iloc[order].reset_index(drop=True)
+    _save_cache(ipi_data, cache)
+    # read back so a fresh call returns the same dtypes as a cached one
+    return pd.read_parquet(cache, dtype_backend='pyarrow')
+
+def all_data(out=False,norm=True,csv=False):
     # This function will merge ipi with gps and emp.
     # and adjust for inflation
     # and create new columns for rates/100k and money percents of whole
     # and get a category column for city size
+    # results are cached in .cache/ until one of the source files changes
+    cache = _cache_path("all_data", _IPI_SOURCES, norm)
+    if os.path.exists(cache):
+        print("Loading cached data")
+    else:
+        _save_cache(_build_all_data(norm), cache)
+    # a fresh build is read back too, so both calls return the same names and dtypes
+    # (the second County comes back as County.1)
+    all_data = pd.read_parquet(cache)
+    if out:
+        print("writing file to ipi_final.parquet")
+        _write_cached(all_data,"ipi_final.csv",csv=csv)
+    return all_data
+
+def _build_all_data(norm):
     print("Loading IPI data")
     ipi_data = funcs.gen_real_dollars() # Get Inflation Adjusted Data
     print("Getting GPS")
-    gps_data = gps()
+    gps_data = gps().convert_dtypes(dtype_backend='numpy_nullable')
     print("Getting Employees")
-    emp_data = emp()
+    emp_data = emp().convert_dtypes(dtype_backend='numpy_nullable')
     print("Merge Everything")
-    merge1 = ipi_data.merge(emp_data,left_on=['FIPS_County','Year4'],right_on=['County FIPS Code','County FIPS Year'])
-    all_data = merge1.merge(gps_data,how='left',on = 'Name')
+    # index the lookup tables once so the joins probe a prebuilt hash
+    emp_data = emp_data.set_index(['County FIPS Code','County FIPS Year'],drop=False)
+    gps_data = gps_data.set_index('Name')
+    all_data = (ipi_data.join(emp_data,on=['FIPS_County','Year4'],how='inner')
+                        .join(gps_data,on='Name',how='left'))
+    blocks = []
     if norm:
         print("Normalize Columns")
-        all_data = funcs.normalize(all_data)
+        blocks = funcs.normalized_blocks(all_data)
     print("Categorize City Size")
-    all_data = funcs.categorize_size(all_data)
-    if out:
-        print("writing file to ipi_final.csv")
-        all_data.to_csv("ipi_final.csv",index=False)
+    size = funcs.size_category(all_data['Population'])
+    # one concat for every derived column instead of inserting them one by one
+    all_data = pd.concat([all_data] + blocks, axis=1)
+    all_data['size'] = size
+    all_data = funcs.optimize_memory(all_data)
     return all_data
 
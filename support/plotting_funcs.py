@@ -1,5 +1,9 @@
+import os
+import re
+import functools
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
 import seaborn as sns
 import matplotlib.pyplot as plt
 import support.load_data as load
@@ -12,47 +16,86 @@ from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import *
 import matplotlib.lines as mlines
 from pandas.plotting._tools import _set_ticks_props, _subplots
-from pandas.core.dtypes.missing import notna
 from scipy.stats import gaussian_kde
-
+try:
+    # binned FFT kde, much faster than gaussian_kde on long columns
+    from KDEpy import FFTKDE
+except ImportError:
+    FFTKDE = None
+
+def _pearson(df):
+    """pearson correlation matrix of df as an array, one BLAS backed call when there are no gaps"""
+    arr = df.to_numpy(dtype=float, na_value=np.nan)
+    if np.isnan(arr).any():
+        # np.corrcoef has no pairwise deletion, let pandas handle the gaps
+        return df.corr().to_numpy()
+    return np.corrcoef(arr, rowvar=False)
+
+def _is_path(data):
+    return isinstance(data, (str, os.PathLike))
+
+def _header(data):
+    """data itself, or an empty frame with the file's column names when data is a path"""
+    if not _is_path(data):
+        return data
+    if str(data).endswith('.csv'):
+        return pd.read_csv(data, nrows=0)
+    return pd.DataFrame(columns=pq.read_schema(data).names)
+
+def _load(data, cols):
+    """data[cols], reading only those columns from disk when data is a parquet/csv path"""
+    if not _is_path(data):
+        return data[cols]
+    if str(data).endswith('.csv'):
+        return pd.read_csv(data, usecols=cols)[cols]
+    return pd.read_parquet(data, columns=cols)
+
+@functools.lru_cache(maxsize=256)
+def _first_match(cols_tuple, pattern):
+    """first column matching pattern (case insensitive), cached for repeated plots"""
+    rx = re.compile(pattern, re.IGNORECASE)
+    return next((c for c in cols_tuple if rx.search(c)), None)
+
+# data may be a dataframe or a path to ipi_final.parquet/.csv, in which case only
+# the columns being plotted are read
 def plot_year(data,search,size=False):
-    cols = funcs.search_all(data,search)
-    if len(cols) > 1:
-        print("\nMORE THAN ONE VALUE FOUND, plotting the first:\n"+cols[0])
-    if len(cols) == 0:
+    col = _first_match(tuple(_header(data).columns),search)
+    if col is None:
         print("error no columns found, exiting")
         return
+    data = _load(data, ['Year4', col] + (['size'] if size else []))
     plt.figure(figsize=[15,9])
     if size:
-        a= sns.barplot(x='Year4',y=cols[0],data=data,hue='size')
+        a= sns.barplot(x='Year4',y=col,data=data,hue='size')
     else:
-        a= sns.barplot(x='Year4',y=cols[0],data=data)
+        a= sns.barplot(x='Year4',y=col,data=data)
     a.set_xticklabels(a.get_xticklabels(), rotation=40, ha="right")
-    plt.ylabel(cols[0].replace("_"," "), fontsize=18)
+    plt.ylabel(col.replace("_"," "), fontsize=18)
     plt.xlabel('Year', fontsize=16)
     plt.xticks( fontsize=14)
-    plt.title(cols[0] + " by Year",fontsize=25)
+    plt.title(col + " by Year",fontsize=25)
     fig = plt.gcf()
     fig.set_size_inches( 16, 10)
     plt.show()
     
 # Plots correlation using a lower triangle heatmap, accepts a dataframe with maximum 20 features
-def plot_corr_matrix(data,cols):
-    subset = data[cols]
+# pass corr (from _pearson) to reuse a matrix already computed for the same cols
+def plot_corr_matrix(data,cols,corr=None):
+    subset = _load(data, list(cols))
     if len(cols) <= 20:
         print("\nThe number of feautures is acceptable, plotting the heatmap correlation:\n")
     if len(cols) > 20:
         print("error: The number of features is not acceptable.")
         return
     sns.set(style="white")
-    plt.figure(figsize=[15,9])
 
     #Compute correlatoin matrix
-    corr = subset.corr()
+    if corr is None:
+        corr = _pearson(subset)
+    corr = np.asarray(corr)
 
     # Generate a mask for the upper triangle
-    mask = np.zeros_like(corr, dtype=np.bool)
-    mask[np.triu_indices_from(mask)] = True
+    mask = np.triu(np.ones(corr.shape, dtype=bool))
 
     # Set up the matplotlib figure
     f, ax = plt.subplots(figsize=(11, 9))
@@ -62,7 +105,8 @@ def plot_corr_matrix(data,cols):
 
     # Draw the heatmap with the mask and correct aspect ratio
     sns.heatmap(corr, mask=mask, cmap=cmap, vmax=.3, center=0,
-                square=True, linewidths=.5, cbar_kws={"shrink": .5})
+                square=True, linewidths=.5, cbar_kws={"shrink": .5},
+                xticklabels=cols, yticklabels=cols)
     plt.show()
     
 # Plots correlation using a scatter plots, accepts dataframe with features
@@ -79,9 +123,11 @@ def plot_scatter_matrix(
     hist_kwds={'bins':20},
     range_padding=0.05,
     plot_axes="lower",  # "all", "lower", "upper"
+    corr=None,
+    max_points=5000,
     **kwds
 ):
-    features = data[cols]
+    features = _load(data, list(cols))
     # plt.figure(figsize=(15,9))
 
     def _get_marker_compat(marker):
@@ -99,7 +145,8 @@ def plot_scatter_matrix(
     # no gaps between subplots
     fig.subplots_adjust(wspace=0, hspace=0)
 
-    mask = notna(df)
+    arr = df.to_numpy(dtype=float, na_value=np.nan)
+    mask = ~np.isnan(arr)
 
     marker = _get_marker_compat(marker)
 
@@ -109,20 +156,21 @@ def plot_scatter_matrix(
     
     kwds.setdefault("edgecolors", "none")
 
-    boundaries_list = []
-    for a in df.columns:
-        values = df[a].values[mask[a].values]
-        rmin_, rmax_ = np.min(values), np.max(values)
-        rdelta_ext = (rmax_ - rmin_) * range_padding / 2.0
-        boundaries_list.append((rmin_ - rdelta_ext, rmax_ + rdelta_ext))
+    rmin_, rmax_ = np.nanmin(arr, axis=0), np.nanmax(arr, axis=0)
+    rdelta_ext = (rmax_ - rmin_) * range_padding / 2.0
+    boundaries_list = list(zip(rmin_ - rdelta_ext, rmax_ + rdelta_ext))
 
     for i, a in enumerate(df.columns):
         for j, b in enumerate(df.columns):
             ax = axes[i, j]
             ax.set_visible(False)  
 
+            # hidden triangle, leave the axis blank instead of labelling it
+            if i != j and not (plot_axes == "all" or (i > j and plot_axes == "lower") or (i < j and plot_axes == "upper")):
+                continue
+
             if i == j:
-                values = df[a].values[mask[a].values]
+                values = arr[mask[:, i], i]
 
                 # Deal with the diagonal by drawing a histogram there.
                 if diagonal == "hist":
@@ -130,19 +178,27 @@ def plot_scatter_matrix(
 
                 elif diagonal in ("kde", "density"):
 
-                    y = values
-                    gkde = gaussian_kde(y)
-                    ind = np.linspace(y.min(), y.max(), 1000)
-                    ax.plot(ind, gkde.evaluate(ind), **density_kwds)
+                    if FFTKDE is not None:
+                        ind, dens = FFTKDE(bw='silverman').fit(values).evaluate(1024)
+                        ax.plot(ind, dens, **density_kwds)
+                    else:
+                        y = values
+                        gkde = gaussian_kde(y)
+                        ind = np.linspace(y.min(), y.max(), 1000)
+                        ax.plot(ind, gkde.evaluate(ind), **density_kwds)
                     
                 ax.set_xlim(boundaries_list[i])
                 ax.set_visible(True)
 
-            elif plot_axes == "all" or (i > j and plot_axes == "lower") or (i < j and plot_axes == "upper"):
-                common = (mask[a] & mask[b]).values
+            else:
+                common = np.flatnonzero(mask[:, i] & mask[:, j])
+                # past a few thousand points the cell looks the same, so only draw a sample
+                if max_points is not None and common.size > max_points:
+                    common = np.random.default_rng(0).choice(common, max_points, replace=False)
 
                 ax.scatter(
-                    df[b][common], df[a][common], marker=marker, alpha=alpha, **kwds
+                    arr[common, j], arr[common, i], marker=marker, alpha=alpha,
+                    rasterized=True, **kwds
                 )
 
                 ax.set_xlim(boundaries_list[j])
@@ -185,8 +241,8 @@ def plot_scatter_matrix(
     _set_ticks_props(axes, xlabelsize=6, xrot=0, ylabelsize=6, yrot=0)
     axes[0][0].yaxis.set_visible(False)
     
-    corrs = df.corr().values
-    for i, j in zip(*plt.np.tril_indices_from(axes, k = 1)):
+    corrs = np.asarray(corr) if corr is not None else _pearson(df)
+    for i, j in zip(*np.tril_indices_from(axes, k=-1)):
         axes[i, j].annotate('Corr. coef = %.3f' % corrs[i, j], (0.8, 0.2), xycoords='axes fraction', ha='center', va='center', size=12)
 
     plt.show()
@@ -1,100 +1,270 @@
 import pandas as pd
-import support.load_data as load
 import re
+import os
+import shutil
+import functools
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+@functools.lru_cache(maxsize=1)
+def _short_names():
+    """ShortName column of col_only.csv as a list, read from a memory mapped arrow copy
+    (the copy is rebuilt whenever the csv changes)"""
+    path = 'col_only.feather'
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime('col_only.csv'):
+        meta = pa_csv.read_csv('col_only.csv')
+        i = meta.schema.get_field_index('ShortName')
+        meta = meta.set_column(i, 'ShortName', meta.column('ShortName').dictionary_encode())
+        # uncompressed so the memory map is zero copy
+        feather.write_feather(meta, path, compression='uncompressed')
+    return feather.read_table(path, memory_map=True).column('ShortName').to_pylist()
+
+def unique_columns(columns):
+    """column names with repeats suffixed .1, .2, ... the way read_csv names them
+    (col_only lists County twice and parquet refuses duplicate names)"""
+    seen = {}
+    unique = []
+    for name in columns:
+        if name in seen:
+            seen[name] += 1
+            unique.append(f"{name}.{seen[name]}")
+        else:
+            seen[name] = 0
+            unique.append(name)
+    return unique
+
+def _field_groups():
+    """expenditure, revenue and rate (per 100k) field names, by position in col_only.csv"""
+    short = _short_names()
+    return short[145:593], short[19:143], short[594:610] + short[612:614] + [short[144], short[18]]
+
+def _finan_fields():
+    """every dollar field that needs an inflation adjustment"""
+    short = _short_names()
+    return short[18:594] + [short[616]]
 
 def search_all(data,search,silent=False):
-    result = (data.filter(regex='(?i)'+search).columns.get_values())
+    # match on the column index directly, filter() would build a sub frame just for its names
+    result = data.columns[data.columns.str.contains(search, case=False, regex=True, na=False)].to_numpy()
     if not silent:
         for item in result:
             print(item)
     return result
+
 def search_column(searchstr,coldata,array=False,disp=False):
     ## allows us to search for column descriptions using a search string
-    searchstr = "(?i)" + searchstr
-    if not array:
-        result= coldata[coldata["ShortName"].str.contains(searchstr, regex=True) == True]
-    else:
-        result =  coldata[coldata["ShortName"].str.contains(searchstr, regex=True) == True]
+    # plain text skips the regex engine, a much cheaper substring search
+    is_regex = re.search(r'[.^$*+?{}\[\]\\|()]', searchstr) is not None
+    hits = coldata["ShortName"].str.contains(searchstr, case=False, regex=is_regex, na=False)
+    result = coldata[hits]
     if disp:
         for item in result['LongName']:
             print(item)
-    return result['ShortName'].get_values()
+    return result['ShortName'].to_numpy(copy=False)
+
+SIZE_LABELS = ['rural','non-urban','urban']
 
-def normalize(input):
+def _fill_population(population):
+    """zeros and gaps filled linearly by row position, matching Series.interpolate()"""
+    pop = population.to_numpy(dtype=float, copy=True, na_value=np.nan)
+    gap = np.isnan(pop) | (pop == 0)
+    if gap.all():
+        pop[:] = np.nan
+        return pop
+    idx = np.arange(len(pop))
+    pop[gap] = np.interp(idx[gap], idx[~gap], pop[~gap])
+    # interpolate() only fills forward, leading gaps stay missing
+    pop[:np.argmax(~gap)] = np.nan
+    return pop
+
+def normalized_blocks(input):
+    """the _PerExp/_PerRev/_100k columns as three frames, ready for a single concat
+    (zero totals become NaN and Population gaps are interpolated on input)"""
+    exp_cols, rev_cols, rate_cols = _field_groups()
+
+    # a zero total means missing, mask it straight in the array that is then both the
+    # stored column and the denominator, rather than replace() followed by a second copy
+    denoms = {}
+    for total in ['Total_Expenditure', 'Total_Revenue']:
+        t = input[total].to_numpy(dtype=float, copy=True, na_value=np.nan)
+        t[t == 0] = np.nan
+        input[total] = denoms[total] = t
+    input['Population'] = denoms['Population'] = _fill_population(input['Population'])
+
+    blocks = []
+    for names, total, scale, suffix in [(exp_cols, 'Total_Expenditure', 100, "_PerExp"),
+                                        (rev_cols, 'Total_Revenue', 100, "_PerRev"),
+                                        (rate_cols, 'Population', 100000, "_100k")]:
+        # one 2d array per group, wrapped without a copy, so each block is a single allocation
+        arr = input[names].to_numpy(dtype=float, na_value=np.nan) / denoms[total][:, None] * scale
+        blocks.append(pd.DataFrame(arr, columns=[item + suffix for item in names],
+                                   index=input.index, copy=False))
+    return blocks
+
+def normalize(input,drop_original=False):
     # normalize stuff and create new variables
-    cols = pd.read_csv('col_only.csv')
-    exp_cols = cols['ShortName'].iloc[ np.concatenate([np.arange(145,593)])].to_list()
-    rev_cols = cols['ShortName'].iloc[ np.concatenate([np.arange(19,143)])].to_list()
-    rate_cols = cols['ShortName'].iloc[ np.concatenate([np.arange(594,610),np.arange(612,614),[144,18]])].to_list()
-
-    input['Total_Expenditure'] = input['Total_Expenditure'].replace(0, np.nan)
-    for item in exp_cols:
-        input[item + "_PerExp"] = (input[item] / input['Total_Expenditure']) * 100
-
-    input['Total_Revenue'] = input['Total_Revenue'].replace(0, np.nan)
-    for item in rev_cols:
-        input[item + "_PerRev"] = (input[item] / input['Total_Revenue']) * 100
-
-    input['Population'] = input['Population'].replace(0, np.nan).interpolate()
-    for item in rate_cols:
-        input[item + "_100k"] = (input[item] / input['Population']) * 100000
-    return input
+    # drop_original leaves out the raw fields the new columns came from (see drop_orig)
+    blocks = normalized_blocks(input)
+    if drop_original:
+        exp_cols, rev_cols, rate_cols = _field_groups()
+        # a boolean mask keeps a repeated name (County) once per column, a name list would not
+        input = input.loc[:, ~input.columns.isin(exp_cols + rev_cols + rate_cols)]
+    return pd.concat([input] + blocks, axis=1)
+
+def size_category(population):
+    """rural below 2500, non-urban up to 50000, urban above, NaN on the boundaries"""
+    pop = population.to_numpy(dtype=float, na_value=np.nan)
+    codes = np.select([pop < 2500, (pop > 2500) & (pop < 50000), pop > 50000], [0, 1, 2], default=-1)
+    return pd.Categorical.from_codes(codes, categories=SIZE_LABELS, ordered=True)
 
 def categorize_size(input):
-    """do nothing"""
-
-    # lower = int(input['Population'].quantile(0.33)//1)
-    # upper = int(input['Population'].quantile(0.66)//1)
-
-    input['size'] = 'na'
-    def category(data):
-        if data['Population'] < 50000 and (data['Population'] > 2500 ):
-            data['size'] = 'non-urban'
-        elif data['Population'] > 50000:
-            data['size'] = 'urban'
-        elif data['Population'] < 2500:
-            data['size'] = 'rural'
-        else:
-            data['size'] = np.nan
-        return data
-    return input.apply(category,axis=1)
+    """add a size column for the city's population bracket"""
+    # set in place, assign would copy the whole wide frame for one column
+    input['size'] = size_category(input['Population'])
+    return input
+
+
+def _ensure_parquet(path, **kw):
+    """parquet copy of an excel workbook, rebuilt when the workbook is newer"""
+    pq_path = os.path.splitext(path)[0] + ".parquet"
+    if not os.path.exists(pq_path) or os.path.getmtime(pq_path) < os.path.getmtime(path):
+        pd.read_excel(path, **kw).to_parquet(pq_path, engine='pyarrow', compression='snappy')
+    return pq_path
+
+if njit is not None:
+    # no fastmath, the financial fields are full of NaNs
+    @njit(parallel=True, cache=True)
+    def _apply_inflation(arr, infl):
+        """scale each row of arr in place by its inflation factor"""
+        # arr is column major, so each inner loop is one contiguous column times infl
+        n, m = arr.shape
+        for j in prange(m):
+            for i in range(n):
+                arr[i, j] *= infl[i]
+        return arr
+elif ne is not None:
+    ne.set_num_threads(os.cpu_count())
+    def _apply_inflation(arr, infl):
+        """scale each row of arr in place by its inflation factor"""
+        # cache blocked and multithreaded, which is what a memory bound multiply needs
+        ne.evaluate('arr * infl2d', local_dict={'arr': arr, 'infl2d': infl.reshape(-1, 1)}, out=arr)
+        return arr
+else:
+    def _apply_inflation(arr, infl):
+        """scale each row of arr in place by its inflation factor"""
+        np.multiply(arr, infl[:, None], out=arr)
+        return arr
 
+# CPI-U the adjusted dollars are expressed in
+CPI_OCT_2019 = 257.346
 
 def conv(init_val):
-    return (1+((257.346 - init_val)/init_val))
+    return (1+((CPI_OCT_2019 - init_val)/init_val))
 
-def gen_real_dollars(out=False):
+_IPI_XLSX = 'Idaho_Municipal_Database_03052019.xlsx'
+_CPI_XLSX = 'bls_cpi_stats.xlsx'
+
+def _real_cache_valid(cache_path, dtype):
+    """cache_path exists, is newer than both workbooks and the field list, and holds
+    dollar fields of dtype"""
+    sources = [_IPI_XLSX, _CPI_XLSX, 'col_only.csv']
+    if not os.path.exists(cache_path) or \
+            os.path.getmtime(cache_path) < max(os.path.getmtime(p) for p in sources):
+        return False
+    field = pq.ParquetDataset(cache_path).schema.field(_finan_fields()[0])
+    return field.type == pa.from_numpy_dtype(dtype)
+
+def gen_real_dollars(out=False,dtype=np.float32,cache_path='ipi_real2019.parquet'):
+    # dollar fields come back as dtype, float32 holds every significant digit these
+    # amounts carry at half the memory, pass np.float64 if you need the extra precision
+    # the result is kept at cache_path (partitioned by Year4) until either workbook or col_only changes
+    # or a different dtype is asked for; cache_path=None always recomputes
+    names = _short_names()
+    if cache_path is not None and _real_cache_valid(cache_path, dtype):
+        real_df = pq.read_table(cache_path, memory_map=True).to_pandas().sort_index()
+        # partition keys come back as a trailing category column
+        real_df['Year4'] = real_df['Year4'].astype(np.int64)
+        real_df = real_df[unique_columns(names)].set_axis(names, axis=1)
+    else:
+        real_df = _real_dollars(dtype)
+        if cache_path is not None:
+            if os.path.exists(cache_path):
+                shutil.rmtree(cache_path)
+            # the index is stored too, so sort_index restores the workbook's row order
+            table = pa.Table.from_pandas(real_df.set_axis(unique_columns(names), axis=1), preserve_index=True)
+            pq.write_to_dataset(table, cache_path, partition_cols=['Year4'], compression='snappy')
+    if out:
+        real_df.to_csv('ipi_real2019.csv', index=False)
+    return real_df
 
+def _real_dollars(dtype):
     # Get CPI Inflation Stats
-    cpi_df = pd.read_excel('bls_cpi_stats.xlsx', header=11)
-    cpi_df = cpi_df.loc[:,['Year','Annual']]
-    cpi_df['Inflation'] = cpi_df['Annual'].map(conv)
+    cpi_df = pd.read_parquet(_ensure_parquet(_CPI_XLSX, header=11), columns=['Year','Annual'])
+    # conv simplifies to CPI_OCT_2019 / init_val, one division over the whole column
+    cpi_df['Inflation'] = CPI_OCT_2019 / cpi_df['Annual']
 
     # Get IPI Columns
-    names = pd.read_csv('col_only.csv')
-    field_names = names['ShortName'].iloc[np.concatenate([np.array([0,2]),np.arange(18,594), [616]])]
+    names = _short_names()
+    finan_fields = _finan_fields()
 
     # Get Municipal Data
-    data_all = pd.read_excel('Idaho_Municipal_Database_03052019.xlsx', header=1)
-    finan_df = data_all.loc[:,field_names]
+    # only the fields listed in col_only are kept, so only those are read; the dollar
+    # fields are cast to dtype while still in arrow so the adjusted values fit back in place
+    table = pq.read_table(_ensure_parquet(_IPI_XLSX, header=1), columns=names)
+    finan = set(finan_fields)
+    target = pa.from_numpy_dtype(dtype)
+    schema = pa.schema([f.with_type(target) if f.name in finan else f for f in table.schema],
+                       metadata=table.schema.metadata)
+    data_all = table.cast(schema).to_pandas()
     print("Adjusting for Inflation")
-    tmp_df = pd.merge(finan_df, cpi_df, left_on='Year4', right_on='Year', how='left')
-    tmp_df.drop(columns=['Name', 'Year4', 'Year', 'Annual'], inplace=True)
-    finan_fields = tmp_df.drop(columns=['Inflation']).columns
-    tmp_df = tmp_df[finan_fields].multiply(tmp_df['Inflation'], axis='index')
-    real_df = data_all.drop(columns=finan_fields)
-    real_df = pd.concat([real_df,tmp_df],axis=1)
-    real_df = real_df[names['ShortName']]
-    if out:
-        real_df.to_csv('ipi_real2019.csv', index=False)
-    return real_df
+    # years are a small dense range, so each row's factor is a plain array index
+    cpi_years = cpi_df['Year'].to_numpy(dtype=np.int64)
+    min_y = cpi_years.min()
+    lut = np.full(cpi_years.max() - min_y + 1, np.nan, dtype=dtype)
+    lut[cpi_years - min_y] = cpi_df['Inflation'].to_numpy(dtype=dtype)
+    offset = data_all['Year4'].to_numpy(dtype=np.int64) - min_y
+    known = (offset >= 0) & (offset < lut.size)
+    infl = np.full(offset.size, np.nan, dtype=dtype)
+    infl[known] = lut[offset[known]]
+    # column major keeps each field contiguous for the kernel
+    moved = [i for i, name in enumerate(names) if name in finan]
+    arr = np.asfortranarray(data_all.iloc[:, moved].to_numpy(copy=True))
+    arr = _apply_inflation(arr, infl)
+    # same dtype as the fields it came from, so this writes into the existing block
+    # rather than adding a block per field
+    data_all.iloc[:, moved] = arr
+    return data_all
+
+def optimize_memory(data):
+    """downcast numeric columns and turn low cardinality strings into categories"""
+    # by position, a repeated name (col_only lists County twice) would select a frame
+    for i, dt in enumerate(data.dtypes):
+        col = data.iloc[:, i]
+        if dt.kind in 'iu':
+            data.isetitem(i, pd.to_numeric(col, downcast='integer'))
+        elif dt.kind == 'f':
+            data.isetitem(i, pd.to_numeric(col, downcast='float'))
+        elif dt.kind == 'O' and col.nunique() < 0.5 * len(data):
+            data.isetitem(i, col.astype('category'))
+    data['Name'] = data['Name'].astype('category')
+    data['size'] = data['size'].astype(pd.CategoricalDtype(SIZE_LABELS, ordered=True))
+    return data
 
 def drop_orig(data):
-    """If you want to drop the original columns after normalizing"""
-    cols = pd.read_csv('col_only.csv')
-    to_drop = cols['ShortName'].iloc[np.concatenate([np.arange(145, 593)])].to_list()
-    to_drop = to_drop + cols['ShortName'].iloc[np.concatenate([np.arange(19, 143)])].to_list()
-    to_drop = to_drop + cols['ShortName'].iloc[np.concatenate([np.arange(594, 610), np.arange(612, 614), [144, 18]])].to_list()
+    """If you want to drop the original columns after normalizing
+    (normalize(data, drop_original=True) does both in one pass)"""
+    exp_cols, rev_cols, rate_cols = _field_groups()
+    to_drop = exp_cols + rev_cols + rate_cols
     data.drop(columns=to_drop,inplace=True)
     return data
\ No newline at end of file
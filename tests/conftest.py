@@ -0,0 +1,16 @@
+import os
+import shutil
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCES = ['Idaho_Municipal_Database_03052019.xlsx', 'bls_cpi_stats.xlsx', 'col_only.csv',
+           'emp_data.csv', 'gps_data.csv', 'best_cities.csv']
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """fresh copy of the source files, so every cache is built from scratch"""
+    for name in SOURCES:
+        shutil.copy(os.path.join(ROOT, name), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
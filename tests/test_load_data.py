@@ -0,0 +1,30 @@
+import os
+import pandas as pd
+import support.load_data as load
+
+
+def test_all_data_out(workdir):
+    data = load.all_data(out=True)
+    assert os.path.exists('ipi_final.parquet')
+    assert data.columns.is_unique
+    assert 'County.1' in data.columns
+    # second call comes from the result cache
+    pd.testing.assert_frame_equal(load.all_data(), data)
+
+    abb = load.ipi_abb()
+    assert set(abb['Year4'].unique()) <= {1997, 2002, 2007, 2012}
+    pd.testing.assert_frame_equal(load.ipi_abb(), abb)
+    # best_cities order and a plain 0..n-1 index, like the right merge it replaced
+    assert abb.index.equals(pd.RangeIndex(len(abb)))
+    best = pd.read_csv('best_cities.csv')['Name']
+    assert list(abb['Name'].unique()) == [n for n in best if n in set(abb['Name'])]
+
+
+def test_ipi_abb_legacy_csv(workdir):
+    # a csv from before the parquet output, with County repeated in the header
+    data = load.all_data()
+    names = ['County' if c == 'County.1' else c for c in data.columns]
+    data.set_axis(names, axis=1).to_csv('ipi_final.csv', index=False)
+    abb = load.ipi_abb(['County', 'Total_Revenue'])
+    assert list(abb.columns[:4]) == ['Name', 'Year4', 'County', 'Total_Revenue']
+    assert len(abb) > 0
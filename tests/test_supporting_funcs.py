@@ -0,0 +1,19 @@
+import os
+import numpy as np
+import pandas as pd
+import support.supporting_funcs as funcs
+
+
+def test_normalize_drop_original(workdir):
+    real = funcs.gen_real_dollars(cache_path=None)
+    # normalize masks totals on its input, so each call gets its own copy
+    dropped = funcs.normalize(real.copy(), drop_original=True)
+    pd.testing.assert_frame_equal(dropped, funcs.drop_orig(funcs.normalize(real.copy())))
+    assert list(dropped.columns).count('County') == 2
+
+
+def test_real_dollars_cache_follows_col_only(workdir):
+    funcs.gen_real_dollars()
+    # a newer field list makes the cache stale, even with the workbooks unchanged
+    os.utime('col_only.csv', (os.path.getmtime('col_only.csv') + 10,) * 2)
+    assert not funcs._real_cache_valid('ipi_real2019.parquet', np.float32)